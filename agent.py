@@ -1,10 +1,19 @@
 import os
+import re
 import sys
+import json
 import time
 import getpass
+import asyncio
+import difflib
+from collections import Counter
 from dotenv import load_dotenv
-from openai import OpenAI
-from slurm_interface import ParamikoSlurmClient
+from openai import AsyncOpenAI
+from slurm_interface import (
+    create_slurm_client, PilotSession, TERMINAL_STATES, POLL_INTERVAL, POLL_BACKOFF, MAX_POLL_INTERVAL
+)
+from prompt_cache import PromptCache
+import script_templates
 
 # Load environment variables
 load_dotenv()
@@ -13,9 +22,31 @@ load_dotenv()
 HOST = "atomgptlab01.wse.jhu.edu"
 USER = "aajith1"
 MODEL = "openai/gpt-oss-20b"
+MAX_POLL_FAILURES = 5 # Consecutive failed status checks before monitoring gives up
+CACHE_DIR = os.path.expanduser("~/.slurm_agent")
+MAX_TOKENS = 512 # A script and one sentence of reasoning fit comfortably
+
+# Kept byte-for-byte identical across calls so the server can reuse the
+# prefilled prefix (prompt caching) instead of reprocessing it every request.
+SYSTEM_PROMPT = """You are an expert HPC engineer.
+Your goal is to write a valid SLURM job script (bash) based on the user's request.
+
+Respond with a single JSON object and nothing else:
+{"reasoning": "<one short sentence on your approach>", "script": "<the complete bash script>"}
+
+Rules:
+1. Include standard #SBATCH directives (job-name, output, time).
+2. Default to --time=00:05:00 unless specified.
+3. If the user asks for python code, use `python3 -c "..."` or create a here-doc.
+"""
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# A complete fenced code block, optionally tagged as bash/sh (used if the
+# endpoint ignores response_format and the model answers in markdown)
+_CODE_BLOCK_RE = re.compile(r"```(?:bash|sh)?[ \t]*\n(.*?)```", re.S)
 
 class AtomGPTAgent:
-    def __init__(self):
+    def __init__(self, use_pilot: bool = False, auto_confirm: bool = False):
         print("🤖 Initializing AtomGPT Agent...")
         
         # 1. Setup OpenAI (AtomGPT)
@@ -24,77 +55,168 @@ class AtomGPTAgent:
             print("⚠️ ATOMGPT_API_KEY not found in environment.")
             api_key = getpass.getpass("🔑 Please enter your AtomGPT API Key: ")
         
-        self.ai_client = OpenAI(
+        self.ai_client = AsyncOpenAI(
             base_url="https://atomgpt.org/api",
             api_key=api_key
         )
+        # One loop for the agent's lifetime, so the async client's connection pool is reused
+        self._loop = asyncio.new_event_loop()
+        self.cache = PromptCache(os.path.join(CACHE_DIR, "prompt_cache.sqlite"))
+        self._fresh_scripts = {} # LLM scripts not cached until the user accepts them
+        self._cached_requests = set() # Requests whose script was served from the cache
         
         # 2. Setup SLURM Connection
         print(f"🔌 Connecting to SLURM at {USER}@{HOST}...")
-        password = os.getenv("SLURM_PASSWORD")
-        if not password:
-            password = getpass.getpass(f"🔑 Please enter SSH password for {USER}@{HOST}: ")
         
-        self.slurm = ParamikoSlurmClient(HOST, USER, password)
-        if not self.slurm.connect():
+        def get_password():
+            # Only needed for the Paramiko fallback
+            password = os.getenv("SLURM_PASSWORD")
+            if not password:
+                password = getpass.getpass(f"🔑 Please enter SSH password for {USER}@{HOST}: ")
+            return password
+        
+        self.slurm = create_slurm_client(HOST, USER, get_password)
+        if self.slurm is None:
             print("❌ Failed to connect to SLURM cluster. Exiting.")
             sys.exit(1)
             
         print("✅ Connected to SLURM!")
+        
+        # Skip the interactive "Submit?" prompts (for programmatic/batch use)
+        self.auto_confirm = auto_confirm
+        
+        # 3. Optionally reuse one allocation for all requests (started on first use)
+        self.pilot = PilotSession(self.slurm) if use_pilot else None
 
     def generate_script(self, user_request: str) -> str:
+        """Synchronous wrapper around generate_script_async."""
+        return self._loop.run_until_complete(self.generate_script_async(user_request))
+
+    def generate_scripts(self, user_requests):
+        """Synchronous wrapper around generate_scripts_async."""
+        return self._loop.run_until_complete(self.generate_scripts_async(user_requests))
+
+    async def generate_scripts_async(self, user_requests):
+        """Generates scripts for several requests with the LLM calls in flight concurrently."""
+        return await asyncio.gather(*[self.generate_script_async(req) for req in user_requests])
+
+    async def generate_script_async(self, user_request: str) -> str:
         """
         Uses OpenAI to generate a SLURM script based on the user request.
         """
         print(f"🧠 Thinking about: '{user_request}'...")
         
-        system_prompt = """You are an expert HPC engineer. 
-        Your goal is to write a valid SLURM job script (bash) based on the user's request.
+        rendered = script_templates.render(user_request)
+        if rendered:
+            print("⚡ Recognized request, rendered script from template.")
+            return rendered
         
-        Rules:
-        1. First, provide a brief "Reasoning:" section explaining your approach.
-        2. Then, provide the bash script in a markdown code block (```bash ... ```).
-        3. Include standard #SBATCH directives (job-name, output, time).
-        4. Default to --time=00:05:00 unless specified.
-        5. If the user asks for python code, use `python3 -c "..."` or create a here-doc.
-        """
+        cached = self.cache.get(MODEL, SYSTEM_PROMPT, user_request)
+        if cached:
+            print("⚡ Reusing cached script for a similar request.")
+            self._cached_requests.add(user_request)
+            return cached
         
         try:
-            response = self.ai_client.chat.completions.create(
+            response = await self.ai_client.chat.completions.create(
                 model=MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_request}
-                ],
-                temperature=0.2
+                messages=[SYSTEM_MESSAGE, {"role": "user", "content": user_request}],
+                temperature=0.2,
+                max_tokens=MAX_TOKENS,
+                response_format={"type": "json_object"}
             )
-            content = response.choices[0].message.content.strip()
+            choice = response.choices[0]
+            content = (choice.message.content or "").strip()
+            if choice.finish_reason == "length":
+                # Cut off mid-reply: the JSON (or script) is incomplete and must not be used
+                print(f"❌ Response truncated at MAX_TOKENS ({MAX_TOKENS}); no usable script.")
+                return ""
             
             # Extract reasoning and script
-            reasoning = "No reasoning provided."
-            script = ""
-            
-            if "Reasoning:" in content:
-                parts = content.split("```", 1)
-                reasoning = parts[0].replace("Reasoning:", "").strip()
-                if len(parts) > 1:
-                    script = "```" + parts[1]
-            else:
-                script = content
+            try:
+                result = json.loads(content)
+                reasoning = result.get("reasoning") or "No reasoning provided."
+                script = result.get("script", "").strip()
+            except (ValueError, AttributeError):
+                match = _CODE_BLOCK_RE.search(content)
+                reasoning = "No reasoning provided."
+                if match:
+                    script = match.group(1).strip()
+                else:
+                    # A bare script is usable; anything else is not
+                    script = content if content.startswith("#!") else ""
 
             print(f"🤔 Agent Reasoning: {reasoning}")
-
-            # Clean up markdown if present
-            if "```bash" in script:
-                script = script.split("```bash")[1].split("```")[0].strip()
-            elif "```" in script:
-                script = script.split("```")[1].split("```")[0].strip()
-                
+            
+            if script:
+                self._fresh_scripts[user_request] = script
+            else:
+                print("❌ No script found in the model's response.")
             return script
         except Exception as e:
             print(f"❌ OpenAI Error: {e}")
             return ""
 
+    def _monitor(self, job_ids, wait_id):
+        """
+        Polls the jobs with exponential backoff until all have finished. Once any is
+        running, blocks remotely on `wait_id` (the job, or the parent array job) instead.
+        """
+        delay = POLL_INTERVAL
+        can_wait = True
+        failures = 0
+        while True:
+            try:
+                statuses = self.slurm.get_job_statuses(job_ids)
+                failures = 0
+            except Exception as e:
+                # Ride out transient SSH/scheduler hiccups; give up if they persist
+                failures += 1
+                if failures >= MAX_POLL_FAILURES:
+                    raise
+                print(f"⚠️ Status check failed ({e}), retrying...")
+                time.sleep(delay)
+                delay = min(delay * POLL_BACKOFF, MAX_POLL_INTERVAL)
+                continue
+            if len(job_ids) == 1:
+                print(f"   Status: {statuses[job_ids[0]]}")
+            else:
+                counts = Counter(statuses.values())
+                print(f"   Status: {', '.join(f'{n} {state}' for state, n in counts.items())}")
+            if all(status in TERMINAL_STATES for status in statuses.values()):
+                return statuses
+            if "RUNNING" in statuses.values() and can_wait:
+                # Block remotely until the job finishes instead of polling. Only done once:
+                # if the wait returns early (e.g. squeue hiccup), plain polling takes over
+                can_wait = False
+                try:
+                    self.slurm.wait_for_job(wait_id)
+                    continue
+                except Exception as e:
+                    print(f"⚠️ Blocking wait failed ({e}), falling back to polling.")
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+    def _remember(self, user_request: str, accepted: bool):
+        """
+        Caches a newly generated script once the user accepts it. A rejected script
+        is never cached, and a rejected cached one is evicted so it is not served again.
+        Template-rendered scripts never touch the cache.
+        """
+        script = self._fresh_scripts.pop(user_request, None)
+        from_cache = user_request in self._cached_requests
+        self._cached_requests.discard(user_request)
+        if accepted:
+            if script:
+                self.cache.put(MODEL, SYSTEM_PROMPT, user_request, script)
+        elif from_cache:
+            self.cache.evict(MODEL, SYSTEM_PROMPT, user_request)
+
+    def _confirm(self, prompt: str) -> bool:
+        if self.auto_confirm:
+            return True
+        return input(prompt).lower() == 'y'
+
     def run_job(self, user_request: str):
         print(f"\n--- Processing Request: {user_request} ---")
         
@@ -105,11 +227,16 @@ class AtomGPTAgent:
 
         print(f"📝 Generated Script:\n{'-'*20}\n{script}\n{'-'*20}")
         
-        confirm = input("❓ Submit this job? (y/n): ")
-        if confirm.lower() != 'y':
+        accepted = self._confirm("❓ Submit this job? (y/n): ")
+        self._remember(user_request, accepted)
+        if not accepted:
             print("🚫 Cancelled.")
             return None
 
+        # Run inside the pilot allocation when possible to skip the queue
+        if self.pilot and self.pilot.fits(script):
+            return self._run_in_pilot(script)
+
         # 2. Submit Job
         try:
             job_id = self.slurm.submit_job(script)
@@ -120,15 +247,13 @@ class AtomGPTAgent:
         # 3. Monitor Job
         print(f"⏳ Monitoring Job {job_id}...")
         try:
-            while True:
-                status = self.slurm.get_job_status(job_id)
-                print(f"   Status: {status}")
-                if status in ["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL"]:
-                    break
-                time.sleep(2)
+            status = self._monitor([job_id], job_id)[job_id]
         except KeyboardInterrupt:
             print("\n⚠️ Monitoring interrupted by user. Job is likely still running.")
             return None
+        except Exception as e:
+            print(f"❌ Monitoring Failed: {e}")
+            return None
             
         # 4. Get Results
         if status == "COMPLETED":
@@ -140,9 +265,99 @@ class AtomGPTAgent:
             print(f"❌ Job finished with status: {status}")
             return None
 
+    def _run_in_pilot(self, script: str):
+        print("🛫 Running inside the pilot allocation...")
+        try:
+            code, out, err = self.pilot.run(script)
+        except KeyboardInterrupt:
+            print("\n⚠️ Interrupted by user.")
+            return None
+        except Exception as e:
+            print(f"❌ Pilot Run Failed: {e}")
+            return None
+        
+        if code == 0:
+            print("\n🎉 Job Finished! Output:")
+            print(f"{'-'*20}\n{out}\n{'-'*20}")
+            return out
+        else:
+            print(f"❌ Job step failed with exit code {code}: {err}")
+            return None
+
+    def close(self):
+        """Releases any resources held on the cluster and closes the connections."""
+        if self.pilot:
+            self.pilot.close()
+        self.slurm.close()
+        self._loop.run_until_complete(self.ai_client.close())
+        self._loop.close()
+
+    def run_batch(self, user_requests):
+        """
+        Runs several requests as one SLURM job array, so N requests cost a single
+        sbatch submission. Returns the outputs in request order (None for failures).
+        """
+        if not user_requests:
+            print("⚠️ No requests to run.")
+            return []
+        print(f"\n--- Processing Batch of {len(user_requests)} Requests ---")
+        
+        # 1. Generate Scripts
+        scripts = self.generate_scripts(user_requests)
+        if not all(scripts):
+            print("❌ Could not generate a script for every request.")
+            return None
+
+        # Show the first script in full and only how the others differ from it
+        print(f"📝 Generated Script for '{user_requests[0]}':\n{'-'*20}\n{scripts[0]}\n{'-'*20}")
+        for req, script in zip(user_requests[1:], scripts[1:]):
+            diff = difflib.unified_diff(scripts[0].splitlines(), script.splitlines(), lineterm="", n=0)
+            changes = "\n".join(list(diff)[2:]) or "(identical)"
+            print(f"📝 Script for '{req}' differs by:\n{changes}\n{'-'*20}")
+        
+        accepted = self._confirm(f"❓ Submit these {len(scripts)} jobs as one job array? (y/n): ")
+        for req in user_requests:
+            self._remember(req, accepted)
+        if not accepted:
+            print("🚫 Cancelled.")
+            return None
+
+        # 2. Submit Job Array
+        try:
+            task_ids = self.slurm.submit_job_array(scripts)
+        except Exception as e:
+            print(f"❌ Submission Failed: {e}")
+            return None
+        array_id = task_ids[0].split("_")[0]
+        
+        # 3. Monitor Job Array
+        print(f"⏳ Monitoring Job Array {array_id}...")
+        try:
+            statuses = self._monitor(task_ids, array_id)
+        except KeyboardInterrupt:
+            print("\n⚠️ Monitoring interrupted by user. Jobs are likely still running.")
+            return None
+        except Exception as e:
+            print(f"❌ Monitoring Failed: {e}")
+            return None
+        
+        # 4. Get Results
+        outputs = []
+        for req, task_id in zip(user_requests, task_ids):
+            status = statuses[task_id]
+            if status == "COMPLETED":
+                output = self.slurm.get_job_output(task_id)
+                print(f"\n🎉 Task {task_id} ('{req}') Finished! Output:\n{'-'*20}\n{output}\n{'-'*20}")
+                outputs.append(output)
+            else:
+                print(f"❌ Task {task_id} ('{req}') finished with status: {status}")
+                outputs.append(None)
+        return outputs
+
 if __name__ == "__main__":
+    agent = None
     try:
-        agent = AtomGPTAgent()
+        agent = AtomGPTAgent(use_pilot=os.getenv("SLURM_AGENT_PILOT") == "1")
         
         while True:
             try:
@@ -159,3 +374,7 @@ if __name__ == "__main__":
         print("\n👋 Exiting...")
     except Exception as e:
         print(f"\n❌ Fatal Error: {e}")
+    finally:
+        # Always release the pilot allocation, even after an unexpected error
+        if agent is not None:
+            agent.close()
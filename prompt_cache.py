@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+from typing import List, Optional, Tuple
+
+# Quoted strings, paths and numbers are the parts of a request that change
+# between otherwise identical workflows, so they are templated out of the key.
+_TEMPLATE_RE = re.compile(
+    r"""(?P<str>'[^']*'|"[^"]*")"""
+    r"""|(?P<path>(?:~|\.{1,2})?/[\w.\-/]+|\b[\w.\-]+/[\w.\-/]+)"""
+    r"""|(?P<num>\b\d+(?:\.\d+)?\b)"""
+)
+
+def template(user_request: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Normalizes a request into a template plus the (kind, value) pairs that were
+    replaced, in order of appearance.
+    """
+    params = []
+
+    def _placeholder(match):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "str":
+            value = value[1:-1]
+        params.append((kind, value))
+        return f"<{kind.upper()}>"
+
+    text = _TEMPLATE_RE.sub(_placeholder, user_request)
+    text = " ".join(text.lower().split())
+    return text, params
+
+def substitute(script: str, old_params, new_params) -> Optional[str]:
+    """
+    Rewrites the values of a cached request in its script with the new request's values.
+    A value is only rewritten where it appears exactly once as a whole token, so it is
+    unambiguous which occurrence it was; otherwise None is returned (treat as a miss).
+    """
+    spans = []
+    for (kind, old), (_, new) in zip(old_params, new_params):
+        if old == new:
+            continue
+        if not old:
+            return None
+        matches = list(re.finditer(rf"(?<![\w.]){re.escape(old)}(?![\w.])", script))
+        if len(matches) != 1:
+            return None
+        spans.append((matches[0].start(), matches[0].end(), new))
+
+    # Rewrite all spans against the original script, so one substitution cannot
+    # feed into the next
+    spans.sort()
+    parts, pos = [], 0
+    for start, end, new in spans:
+        if start < pos:
+            return None
+        parts.append(script[pos:start])
+        parts.append(new)
+        pos = end
+    parts.append(script[pos:])
+    return "".join(parts)
+
+class PromptCache:
+    """
+    On-disk cache of generated scripts keyed on (model, system prompt, request template).
+
+    Exact template matches are served from SQLite. Near matches are tried next,
+    cheapest first: a MinHash LSH index over the template's words (if `datasketch`
+    is installed), then embedding similarity (if `sentence-transformers` is installed).
+    """
+
+    def __init__(self, path: str, similarity_threshold: float = 0.92,
+                 embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+                 minhash_threshold: float = 0.85, num_perm: int = 64):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts ("
+            "model TEXT, prompt_hash TEXT, template TEXT, params TEXT, script TEXT, "
+            "PRIMARY KEY (model, prompt_hash, template))"
+        )
+        self.db.commit()
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = embedding_model
+        self._encoder = None
+        self._embeddings = None # List of (model, prompt_hash, template, embedding)
+        self.minhash_threshold = minhash_threshold
+        self.num_perm = num_perm
+        self._lsh = None # MinHashLSH over "model|prompt_hash|template" keys, rebuilt from the DB
+        self._minhashes = {}
+
+    @staticmethod
+    def _hash(system_prompt: str) -> str:
+        return hashlib.sha256(system_prompt.encode()).hexdigest()
+
+    def _encode(self, text):
+        if self._encoder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                self._encoder = False
+                return None
+            self._encoder = SentenceTransformer(self.embedding_model)
+        if self._encoder is False:
+            return None
+        return self._encoder.encode(text, normalize_embeddings=True)
+
+    def _load_embeddings(self):
+        if self._embeddings is not None:
+            return
+        self._embeddings = []
+        rows = self.db.execute("SELECT model, prompt_hash, template FROM prompts").fetchall()
+        for model, prompt_hash, tmpl in rows:
+            embedding = self._encode(tmpl)
+            if embedding is None:
+                return
+            self._embeddings.append((model, prompt_hash, tmpl, embedding))
+
+    def _minhash(self, tmpl):
+        try:
+            from datasketch import MinHash
+        except ImportError:
+            return None
+        m = MinHash(num_perm=self.num_perm)
+        for word in set(re.findall(r"\w+", tmpl)):
+            m.update(word.encode())
+        return m
+
+    def _index_minhash(self, model, prompt_hash, tmpl) -> bool:
+        key = f"{model}|{prompt_hash}|{tmpl}"
+        if key in self._minhashes:
+            return True
+        m = self._minhash(tmpl)
+        if m is None:
+            return False
+        self._lsh.insert(key, m)
+        self._minhashes[key] = m
+        return True
+
+    def _load_lsh(self):
+        if self._lsh is not None:
+            return
+        try:
+            from datasketch import MinHashLSH
+        except ImportError:
+            self._lsh = False
+            return
+        # Signatures are cheap to recompute, so the index is rebuilt from the DB
+        # rather than pickled alongside it
+        self._lsh = MinHashLSH(threshold=self.minhash_threshold, num_perm=self.num_perm)
+        for model, prompt_hash, tmpl in self.db.execute("SELECT model, prompt_hash, template FROM prompts"):
+            self._index_minhash(model, prompt_hash, tmpl)
+
+    def _minhash_match(self, model, prompt_hash, tmpl) -> Optional[str]:
+        self._load_lsh()
+        if self._lsh is False:
+            return None
+        query = self._minhash(tmpl)
+        # LSH candidates are only probable matches, so the estimated similarity
+        # must still clear the threshold itself
+        best, best_score = None, self.minhash_threshold
+        for key in self._lsh.query(query):
+            m, h, t = key.split("|", 2)
+            if m != model or h != prompt_hash:
+                continue
+            score = query.jaccard(self._minhashes[key])
+            if score >= best_score:
+                best, best_score = t, score
+        return best
+
+    def _embedding_match(self, model, prompt_hash, tmpl) -> Optional[str]:
+        self._load_embeddings()
+        query = self._encode(tmpl)
+        if query is None:
+            return None
+        best, best_score = None, self.similarity_threshold
+        for m, h, t, embedding in self._embeddings:
+            if m != model or h != prompt_hash:
+                continue
+            score = float(query @ embedding)
+            if score >= best_score:
+                best, best_score = t, score
+        return best
+
+    def _lookup(self, model, prompt_hash, tmpl) -> Optional[str]:
+        """Returns the stored template that serves `tmpl`: exact first, then near matches."""
+        row = self.db.execute(
+            "SELECT 1 FROM prompts WHERE model = ? AND prompt_hash = ? AND template = ?",
+            (model, prompt_hash, tmpl)
+        ).fetchone()
+        if row is not None:
+            return tmpl
+        return (self._minhash_match(model, prompt_hash, tmpl)
+                or self._embedding_match(model, prompt_hash, tmpl))
+
+    def get(self, model: str, system_prompt: str, user_request: str) -> Optional[str]:
+        """Returns a cached script for a structurally similar request, or None on miss."""
+        prompt_hash = self._hash(system_prompt)
+        tmpl, params = template(user_request)
+        match = self._lookup(model, prompt_hash, tmpl)
+        if match is None:
+            return None
+        row = self.db.execute(
+            "SELECT params, script FROM prompts WHERE model = ? AND prompt_hash = ? AND template = ?",
+            (model, prompt_hash, match)
+        ).fetchone()
+
+        cached_params = [tuple(p) for p in json.loads(row[0])]
+        # Placeholders can only be re-substituted if the requests line up value for value
+        if [k for k, _ in cached_params] != [k for k, _ in params]:
+            return None
+        return substitute(row[1], cached_params, params)
+
+    def put(self, model: str, system_prompt: str, user_request: str, script: str):
+        """Stores the script generated for a request."""
+        prompt_hash = self._hash(system_prompt)
+        tmpl, params = template(user_request)
+        self.db.execute(
+            "INSERT OR REPLACE INTO prompts VALUES (?, ?, ?, ?, ?)",
+            (model, prompt_hash, tmpl, json.dumps(params), script)
+        )
+        self.db.commit()
+        if self._lsh:
+            self._index_minhash(model, prompt_hash, tmpl)
+        if self._embeddings is not None:
+            embedding = self._encode(tmpl)
+            if embedding is not None:
+                self._embeddings.append((model, prompt_hash, tmpl, embedding))
+
+    def evict(self, model: str, system_prompt: str, user_request: str):
+        """Removes the entry that would be served for a request (e.g. after the user rejected it)."""
+        prompt_hash = self._hash(system_prompt)
+        tmpl, _ = template(user_request)
+        match = self._lookup(model, prompt_hash, tmpl)
+        if match is None:
+            return
+        self.db.execute(
+            "DELETE FROM prompts WHERE model = ? AND prompt_hash = ? AND template = ?",
+            (model, prompt_hash, match)
+        )
+        self.db.commit()
+        key = f"{model}|{prompt_hash}|{match}"
+        if self._lsh and key in self._minhashes:
+            self._lsh.remove(key)
+            del self._minhashes[key]
+        if self._embeddings is not None:
+            self._embeddings = [e for e in self._embeddings if e[:3] != (model, prompt_hash, match)]
@@ -0,0 +1,65 @@
+import os
+import re
+import shlex
+from typing import Dict, Optional, Tuple
+
+try:
+    from jinja2 import Environment, FileSystemLoader, StrictUndefined
+except ImportError:
+    Environment = None
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+DEFAULT_TIME = "00:05:00"
+
+# Optional trailing resources, shared by every intent: "... on 8 cores for 10 minutes"
+_RESOURCES = r"(?:\s+(?:on|with)\s+(?P<cores>\d+)\s+(?:cores?|cpus?))?(?:\s+for\s+(?P<minutes>\d+)\s+min(?:ute)?s?)?\s*\.?\s*$"
+_QUOTED = r"(?P<q>[`'\"])(?P<{}>.+?)(?P=q)"
+
+# Requests that map onto a pre-validated template, tried in order
+INTENTS = [
+    ("python_oneliner", re.compile(
+        r"^(?:please\s+)?(?:run|execute)\s+(?:the\s+)?python3?\s+(?:code\s+|snippet\s+)?" + _QUOTED.format("code") + _RESOURCES, re.I)),
+    ("shell_command", re.compile(
+        r"^(?:please\s+)?(?:run|execute)\s+(?:the\s+)?(?:shell\s+)?command\s+" + _QUOTED.format("command") + _RESOURCES, re.I)),
+    ("echo", re.compile(
+        r"^(?:please\s+)?(?:write|run|submit|create)\s+a\s+job\s+that\s+(?:prints|echoes)\s+" + _QUOTED.format("text") + _RESOURCES, re.I)),
+]
+
+_env = None
+
+def _environment():
+    global _env
+    if _env is None:
+        _env = Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR),
+            undefined=StrictUndefined,
+            keep_trailing_newline=True,
+        )
+        _env.filters["quote"] = shlex.quote
+    return _env
+
+def classify(user_request: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    """Returns (intent, template parameters) if the request matches a known intent, else None."""
+    for intent, pattern in INTENTS:
+        match = pattern.match(user_request.strip())
+        if not match:
+            continue
+        params = {k: v for k, v in match.groupdict().items() if k not in ("q", "cores", "minutes")}
+        params["cores"] = match.group("cores") or "1"
+        minutes = int(match.group("minutes")) if match.group("minutes") else None
+        params["time"] = f"{minutes // 60:02d}:{minutes % 60:02d}:00" if minutes else DEFAULT_TIME
+        return intent, params
+    return None
+
+def render(user_request: str) -> Optional[str]:
+    """
+    Renders the template for a recognized request, bypassing the LLM entirely.
+    Returns None if the request is not recognized or jinja2 is not installed.
+    """
+    if Environment is None:
+        return None
+    result = classify(user_request)
+    if result is None:
+        return None
+    intent, params = result
+    return _environment().get_template(f"{intent}.sh.j2").render(**params).strip()
@@ -1,8 +1,94 @@
+import os
+import re
+import json
 import time
+import shlex
 import random
+import shutil
+import tempfile
+import subprocess
+from io import BytesIO
 import paramiko
 from abc import ABC, abstractmethod
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Generator, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Where job_id -> output file mappings are kept across restarts
+JOBS_FILE = os.path.expanduser("~/.slurm_agent/jobs.json")
+
+# Status polling: first interval, growth factor per poll, and cap (seconds)
+POLL_INTERVAL = 2
+POLL_BACKOFF = 1.5
+MAX_POLL_INTERVAL = 30
+
+# States after which a job will not change again
+TERMINAL_STATES = [
+    "COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL",
+    "BOOT_FAIL", "DEADLINE", "OUT_OF_MEMORY", "PREEMPTED",
+]
+
+# squeue -t filter for jobs that have not finished. squeue keeps listing finished
+# jobs (CD, F, CA, ...) until slurmctld purges them after MinJobAge, so remote wait
+# loops must not treat "still listed" as "still running"
+ACTIVE_STATES = "PD,R,CG,S,CF,RQ,RS"
+
+# Marks the end of each command's output in a batched exec
+_SENTINEL = "__SLURM_AGENT_SEP__"
+_SENTINEL_RE = re.compile(rb"\n" + _SENTINEL.encode() + rb"(\d+)\n")
+
+# squeue reports pending array tasks collapsed, e.g. "123_[0-3,7%2]"
+_ARRAY_RANGE_RE = re.compile(r"^(\d+)_\[([\d,\-]+)(?:%\d+)?\]$")
+
+# A whole #SBATCH line, capturing the directive and its option name
+_DIRECTIVE_RE = re.compile(r"^[ \t]*(#SBATCH[ \t]+--?([\w-]+).*?)[ \t]*$", re.M)
+_OUTPUT_RE = re.compile(r"^[ \t]*#SBATCH[ \t]+--output=(\S+)", re.M)
+_STDOUT_RE = re.compile(r"\bStdOut=(\S+)")
+_TIME_RE = re.compile(r"^[ \t]*#SBATCH[ \t]+(?:--time[= \t]|-t[ \t]*)[ \t]*(\S+)", re.M)
+
+def _parse_job_id(out: str) -> str:
+    """Parses the `<jobid>[;cluster]` printed by `sbatch --parsable`."""
+    job_id = out.split(";")[0].strip()
+    if not job_id.isdigit():
+        raise Exception(f"Could not parse job ID from sbatch output: {out}")
+    return job_id
+
+def _time_seconds(value: str) -> float:
+    """
+    Converts a Slurm time limit ("M", "M:S", "H:M:S", "D-H", "D-H:M", "D-H:M:S")
+    into seconds. Raises ValueError if it cannot be parsed.
+    """
+    if value.upper() in ("UNLIMITED", "INFINITE"):
+        return float("inf")
+    days, _, clock = value.rpartition("-")
+    parts = [int(x) for x in clock.split(":")]
+    if len(parts) > 3 or (days and not days.isdigit()):
+        raise ValueError(f"Invalid time limit: {value}")
+    if days:
+        h, m, s = parts + [0] * (3 - len(parts))
+    else:
+        h, m, s = [0] * (3 - len(parts)) + parts if len(parts) > 1 else (0, parts[0], 0)
+    return int(days or 0) * 86400 + h * 3600 + m * 60 + s
+
+def _parse_queue(out: bytes) -> Dict[str, str]:
+    """Parses `squeue -o "%i %T"` output into job_id -> state, expanding array task ranges."""
+    states = {}
+    for line in out.splitlines():
+        if not line.strip():
+            continue
+        job_id, state = line.decode().split(None, 1)
+        match = _ARRAY_RANGE_RE.match(job_id)
+        if not match:
+            states[job_id] = state
+            continue
+        for part in match.group(2).split(","):
+            first, _, last = part.partition("-")
+            for task in range(int(first), int(last or first) + 1):
+                states[f"{match.group(1)}_{task}"] = state
+    return states
 
 class SlurmClient(ABC):
     """Abstract base class for SLURM interactions."""
@@ -22,17 +108,337 @@ class SlurmClient(ABC):
         """Returns the stdout/stderr of the job."""
         pass
 
-class ParamikoSlurmClient(SlurmClient):
-    """Actual SLURM client using SSH via Paramiko."""
+class SSHSlurmClient(SlurmClient):
+    """
+    SLURM client that drives the scheduler's CLI over SSH. Subclasses provide the
+    transport: running a command, streaming its output, and reading/writing files.
+    """
+    
+    STATUS_CACHE_TTL = 2 # Seconds a squeue snapshot is shared between lookups
+    SUBMIT_GRACE = 60 # Seconds a new job may be invisible to squeue/sacct before it counts as finished
     
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, jobs_file: str = JOBS_FILE):
         self.host = host
         self.user = user
+        self.jobs_file = jobs_file
+        self.job_files = self._load_job_files() # Map job_id -> output_filename_pattern
+        self._status_cache = {} # Map job_id -> state, from one squeue call for all of our jobs
+        self._status_cache_ts = 0
+        self._submitted_at = {} # Map job_id -> submit time, for jobs submitted this session
+
+    def _read_jobs_file(self) -> Dict[str, Dict[str, str]]:
+        try:
+            with open(self.jobs_file, "rb") as f:
+                data = f.read()
+            return orjson.loads(data) if orjson else json.loads(data)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_job_files(self) -> Dict[str, str]:
+        """Loads the output file mappings saved for this cluster by earlier sessions."""
+        return self._read_jobs_file().get(f"{self.user}@{self.host}", {})
+
+    def _persist(self):
+        """
+        Atomically saves job_files, so output can still be found after a restart.
+        Failing to save only costs that, so it is reported rather than raised: the job
+        is already queued and must still be monitored.
+        """
+        data = self._read_jobs_file()
+        data[f"{self.user}@{self.host}"] = self.job_files
+        directory = os.path.dirname(self.jobs_file) or "."
+        tmp = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as f:
+                tmp = f.name
+                f.write(orjson.dumps(data) if orjson else json.dumps(data).encode())
+            os.replace(tmp, self.jobs_file)
+        except OSError as e:
+            print(f"⚠️ Could not save job records to {self.jobs_file}: {e}")
+            if tmp:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    @abstractmethod
+    def connect(self) -> bool:
+        """Establishes the SSH connection."""
+        pass
+
+    @abstractmethod
+    def close(self):
+        """Closes the SSH connection."""
+        pass
+
+    @abstractmethod
+    def _exec(self, command: str, input: str = None) -> Tuple[int, bytes, bytes]:
+        """Runs a remote command and returns (exit code, stdout, stderr)."""
+        pass
+
+    @abstractmethod
+    def _stream_command(self, command: str) -> Generator[str, None, int]:
+        """Yields a remote command's stdout line by line, then returns its exit code."""
+        pass
+
+    @abstractmethod
+    def upload(self, content: str, path: str):
+        """Writes a remote file."""
+        pass
+
+    @abstractmethod
+    def _mkdir(self, path: str):
+        pass
+
+    @abstractmethod
+    def _read_file(self, path: str) -> bytes:
+        """Reads a remote file, raising IOError if it does not exist."""
+        pass
+
+    def _run_command(self, command, input: str = None):
+        """Text wrapper around _exec, for callers that need decoded output."""
+        exit_status, out, err = self._exec(command, input)
+        return exit_status, out.strip().decode(), err.strip().decode()
+
+    def _exec_batched(self, commands: List[str]) -> List[Tuple[int, bytes, bytes]]:
+        """
+        Runs several commands over a single SSH channel, saving a round-trip per command.
+        Each command is followed by a sentinel on stdout (carrying its exit code) and on
+        stderr, which are used to split the combined output back into per-command results.
+        Output is left as bytes; callers decode only what they use.
+        """
+        script = "; ".join(
+            f"{cmd}; printf '\\n{_SENTINEL}%d\\n' $?; printf '\\n{_SENTINEL}\\n' >&2" for cmd in commands
+        )
+        code, out, err = self._exec(script)
+        
+        outs = _SENTINEL_RE.split(out)  # [out0, code0, out1, code1, ..., trailing]
+        errs = err.split(b"\n" + _SENTINEL.encode() + b"\n")
+        # Missing sentinels mean the session died part-way (e.g. the SSH connection dropped)
+        if len(outs) < 2 * len(commands) + 1 or len(errs) < len(commands):
+            raise Exception(
+                f"Batched command failed (exit code {code}) after {len(outs) // 2} of "
+                f"{len(commands)} commands: {err.decode(errors='replace').strip()}"
+            )
+        return [
+            (int(outs[2 * i + 1]), outs[2 * i].strip(), errs[i].strip())
+            for i in range(len(commands))
+        ]
+
+    def submit_job(self, script_content: str) -> str:
+        # Submit via sbatch, piping the script over the exec channel's stdin
+        # (one round-trip and no job_*.sh left on the login node)
+        code, out, err = self._run_command("sbatch --parsable", input=script_content)
+        
+        if code != 0:
+            raise Exception(f"sbatch failed: {err}")
+            
+        job_id = _parse_job_id(out)
+
+        # Parse output filename from script
+        # Look for #SBATCH --output=...
+        match = _OUTPUT_RE.search(script_content)
+        output_pattern = match.group(1) if match else "slurm-%j.out" # Default
+        
+        self.job_files[job_id] = output_pattern
+        self._persist()
+        self._record_submission([job_id])
+        print(f"🚀 Job submitted! ID: {job_id} (Output: {output_pattern})")
+        return job_id
+
+    def submit_job_array(self, scripts: List[str]) -> List[str]:
+        """
+        Submits several scripts as a single SLURM job array and returns the task IDs
+        ("<array_id>_<index>"), one per script in order.
+        
+        Each script is run with `bash`, so the resources come from the array wrapper,
+        which reuses the #SBATCH directives of the first script. All scripts must
+        therefore request the same resources.
+        """
+        if not scripts:
+            raise Exception("No scripts to submit.")
+        directives = self._resource_directives(scripts[0])
+        for i, script in enumerate(scripts[1:], 1):
+            if sorted(self._resource_directives(script)) != sorted(directives):
+                raise Exception(
+                    f"Script {i} requests different resources than script 0; "
+                    "a job array shares one set of #SBATCH directives, so submit them separately."
+                )
+        # Random suffix so batches submitted within the same second get their own directory
+        jobdir = f"job_{int(time.time())}_{os.urandom(4).hex()}"
+        
+        # 1. Upload every task script plus the wrapper
+        directives += [
+            match.group(1) for match in _DIRECTIVE_RE.finditer(scripts[0])
+            if match.group(2) in ("job-name", "J")
+        ]
+        wrapper = "\n".join([
+            "#!/bin/bash",
+            *directives,
+            f"#SBATCH --array=0-{len(scripts) - 1}",
+            f"#SBATCH --output={jobdir}/slurm-%A_%a.out",
+            f"bash {jobdir}/task_${{SLURM_ARRAY_TASK_ID}}.sh",
+        ]) + "\n"
+        try:
+            self._mkdir(jobdir)
+            for i, script in enumerate(scripts):
+                self.upload(script, f"{jobdir}/task_{i}.sh")
+            self.upload(wrapper, f"{jobdir}/array.sh")
+        except Exception as e:
+            raise Exception(f"Failed to upload scripts: {e}")
+        
+        # 2. Submit the wrapper once for all tasks
+        code, out, err = self._run_command(f"sbatch --parsable {jobdir}/array.sh")
+        if code != 0:
+            raise Exception(f"sbatch failed: {err}")
+        array_id = _parse_job_id(out)
+        
+        task_ids = [f"{array_id}_{i}" for i in range(len(scripts))]
+        for task_id in task_ids:
+            self.job_files[task_id] = f"{jobdir}/slurm-{task_id}.out"
+        self._persist()
+        self._record_submission(task_ids)
+        print(f"🚀 Job array submitted! ID: {array_id} ({len(scripts)} tasks, output in {jobdir}/)")
+        return task_ids
+
+    @staticmethod
+    def _resource_directives(script_content: str) -> List[str]:
+        """The #SBATCH lines of a script other than those the array wrapper sets per task."""
+        return [
+            match.group(1) for match in _DIRECTIVE_RE.finditer(script_content)
+            if match.group(2) not in ("output", "error", "array", "job-name", "o", "e", "a", "J")
+        ]
+
+    def _record_submission(self, job_ids: List[str]):
+        """Drops the squeue snapshot, which predates the new jobs, and notes when they were submitted."""
+        self._status_cache_ts = 0
+        now = time.time()
+        for jid in job_ids:
+            self._submitted_at[jid] = now
+
+    def get_job_status(self, job_id: str) -> str:
+        return self.get_job_statuses([job_id])[job_id]
+
+    def get_job_statuses(self, job_ids: List[str]) -> Dict[str, str]:
+        """Returns the status of several jobs using at most one SSH round-trip."""
+        sacct_out = None
+        if time.time() - self._status_cache_ts >= self.STATUS_CACHE_TTL:
+            # Snapshot all of the user's queued jobs and, in the same exec, the
+            # accounting records of any that have already left the queue
+            (code, out, err), (_, sacct_out, _) = self._exec_batched([
+                f'squeue -u {self.user} -h -o "%i %T"',
+                f"sacct -j {','.join(job_ids)} -n -P -o JobID,State",
+            ])
+            if code == 0:
+                self._status_cache = _parse_queue(out)
+                self._status_cache_ts = time.time()
+            else:
+                # An old snapshot would keep reporting jobs that have since finished;
+                # fall through to the sacct output from this same exec instead
+                self._status_cache = {}
+        statuses = {jid: self._status_cache[jid] for jid in job_ids if jid in self._status_cache}
+        
+        # Jobs no longer in the queue: check sacct for their final state
+        missing = [jid for jid in job_ids if jid not in statuses]
+        if missing:
+            if sacct_out is None:
+                code, sacct_out, err = self._exec(f"sacct -j {','.join(missing)} -n -P -o JobID,State")
+            wanted = {jid.encode(): jid for jid in missing}
+            for line in sacct_out.splitlines():
+                jid, _, state = line.partition(b"|")
+                # Skip job steps (e.g. 123.batch); keep the first word of the state (e.g. CANCELLED by ...)
+                jid = wanted.get(jid)
+                if jid and state.strip() and jid not in statuses:
+                    statuses[jid] = state.split(None, 1)[0].decode()
+        
+        # Fallback: assume completed if not in queue, unless we only just submitted it
+        # (the controller and accounting can lag behind sbatch)
+        for jid in missing:
+            just_submitted = time.time() - self._submitted_at.get(jid, 0) < self.SUBMIT_GRACE
+            statuses.setdefault(jid, "PENDING" if just_submitted else "COMPLETED")
+        return statuses
+
+    def wait_for_job(self, job_id: str, poll_interval: int = 5) -> str:
+        """
+        Blocks until the job has finished and returns its final state.
+        The wait loop runs on the login node, so it costs a single SSH round-trip
+        no matter how long the job runs.
+        """
+        code, out, err = self._exec(
+            f"while squeue -j {job_id} -t {ACTIVE_STATES} -h -o %T 2>/dev/null | grep -q .; do sleep {poll_interval}; done"
+        )
+        if code != 0:
+            raise Exception(f"Waiting for job {job_id} failed: {err.decode().strip()}")
+        self._status_cache_ts = 0 # Snapshot may predate the job finishing
+        return self.get_job_status(job_id)
+
+    def cancel_job(self, job_id: str):
+        """Cancels a job (or releases an allocation)."""
+        code, out, err = self._run_command(f"scancel {job_id}")
+        if code != 0:
+            raise Exception(f"scancel failed: {err}")
+        self._status_cache_ts = 0
+
+    def run_in_allocation(self, job_id: str, script_content: str) -> Tuple[int, str, str]:
+        """
+        Runs a script as a job step of a running allocation and returns (exit code, stdout, stderr).
+        The script is fed to `bash -s` over stdin, so nothing is left on the login node.
+        """
+        return self._run_command(f"srun --jobid={job_id} --overlap -N1 -n1 bash -s", input=script_content)
+
+    def _output_file(self, job_id: str) -> str:
+        if job_id in self.job_files:
+            return self.job_files[job_id].replace("%j", job_id)
+        # Unknown job (e.g. submitted elsewhere): ask the controller, which has the resolved path
+        code, out, err = self._run_command(f"scontrol show job -o {job_id}")
+        match = _STDOUT_RE.search(out)
+        if code == 0 and match:
+            return match.group(1)
+        return f"slurm-{job_id}.out"
+
+    def stream_job_output(self, job_id: str, poll_interval: int = 2, file_timeout: int = 30) -> Iterator[str]:
+        """
+        Yields the job's output line by line as it is written, until the job has
+        finished and the file is fully read. A single blocking `tail` on the login
+        node replaces polling: it waits for the file to appear, follows it, and exits
+        once the watcher (job done, then up to `file_timeout` s for the file) finishes.
+        """
+        outfile = self._output_file(job_id)
+        path = shlex.quote(outfile)
+        watcher = (
+            f"while squeue -j {job_id} -t {ACTIVE_STATES} -h -o %T 2>/dev/null | grep -q .; do sleep {poll_interval}; done; "
+            f"for i in $(seq {file_timeout}); do [ -e {path} ] && break; sleep 1; done"
+        )
+        code = yield from self._stream_command(
+            f"({watcher}) & WATCHER=$!; tail -n +1 -F --pid=$WATCHER {path} 2>/dev/null; test -e {path}"
+        )
+        if code != 0:
+            raise IOError(f"Output file {outfile} not found.")
+
+    def get_job_output(self, job_id: str) -> str:
+        # Fast path for finished jobs: read the whole file in one go
+        outfile = self._output_file(job_id)
+        try:
+            return self._read_file(outfile).decode(errors="replace").strip()
+        except IOError:
+            pass
+        
+        # File not there yet: follow it until the job is done
+        try:
+            return "".join(self.stream_job_output(job_id)).strip()
+        except IOError as e:
+            return str(e)
+
+class ParamikoSlurmClient(SSHSlurmClient):
+    """Actual SLURM client using SSH via Paramiko."""
+    
+    def __init__(self, host, user, password, jobs_file: str = JOBS_FILE):
+        super().__init__(host, user, jobs_file)
         self.password = password
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.sftp = None
-        self.job_files = {} # Map job_id -> output_filename_pattern
         print(f"🔌 Initialized ParamikoSlurmClient for {user}@{host}")
 
     def connect(self):
@@ -45,85 +451,263 @@ class ParamikoSlurmClient(SlurmClient):
             print(f"❌ Connection failed: {e}")
             return False
 
-    def _run_command(self, command):
+    def close(self):
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
+        self.client.close()
+
+    def _exec(self, command, input: str = None):
         stdin, stdout, stderr = self.client.exec_command(command)
-        exit_status = stdout.channel.recv_exit_status()
-        return exit_status, stdout.read().decode().strip(), stderr.read().decode().strip()
+        if input is not None:
+            stdin.write(input)
+            stdin.channel.shutdown_write()
+        # Drain the output before waiting for the exit status, so a large output
+        # cannot fill the channel window and stall the remote command
+        out = stdout.read()
+        err = stderr.read()
+        return stdout.channel.recv_exit_status(), out, err
 
-    def submit_job(self, script_content: str) -> str:
-        # 1. Create a remote script file using SFTP
-        filename = f"job_{int(time.time())}.sh"
-        
+    def _stream_command(self, command):
+        stdin, stdout, stderr = self.client.exec_command(command)
+        for line in stdout:
+            yield line
+        return stdout.channel.recv_exit_status()
+
+    def upload(self, content: str, path: str):
+        """
+        Writes a remote file over the open SFTP session. putfo pipelines the WRITE
+        requests, and confirm=False skips the follow-up stat round-trip.
+        """
+        self.sftp.putfo(BytesIO(content.encode()), path, confirm=False)
+
+    def _mkdir(self, path: str):
+        self.sftp.mkdir(path)
+
+    def _read_file(self, path: str) -> bytes:
+        # prefetch() pipelines the READ requests instead of waiting on each 32 KiB block in turn
+        chunks = []
+        with self.sftp.open(path, 'r') as f:
+            f.prefetch()
+            while chunk := f.read(1 << 20):
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+class OpenSSHSlurmClient(SSHSlurmClient):
+    """
+    SLURM client using the system `ssh` binary with connection multiplexing.
+    A background master connection is kept open on a control socket and every
+    command reuses it, so each command costs a channel open instead of a full
+    handshake, and the crypto runs in OpenSSH rather than in Python. Requires
+    key/agent authentication (BatchMode), since no password can be passed to `ssh`.
+    """
+    
+    CONNECT_TIMEOUT = 30 # Seconds allowed for starting the master connection
+    
+    def __init__(self, host, user, jobs_file: str = JOBS_FILE, control_persist: int = 600):
+        super().__init__(host, user, jobs_file)
+        self.control_path = os.path.join(tempfile.gettempdir(), "ssa-%C")
+        self.control_persist = control_persist
+        # Commands only attach to the master; it is started explicitly by _ensure_master
+        self.ssh = [
+            "ssh",
+            "-o", f"ControlPath={self.control_path}",
+            "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout=10",
+            f"{user}@{host}",
+        ]
+        self._last_used = 0 # When the master last carried a command
+        print(f"🔌 Initialized OpenSSHSlurmClient for {user}@{host}")
+
+    def _control(self, operation: str) -> subprocess.CompletedProcess:
+        """Sends a control command (check, exit) to the master connection."""
+        return subprocess.run(
+            self.ssh[:-1] + ["-O", operation, self.ssh[-1]],
+            stdin=subprocess.DEVNULL, capture_output=True, timeout=self.CONNECT_TIMEOUT,
+        )
+
+    def _ensure_master(self):
+        """
+        Starts the master connection unless one is already up. It exits after
+        `control_persist` idle seconds, so it is only re-checked after a long gap.
+        """
+        if time.time() - self._last_used < self.control_persist - 30:
+            return
+        if self._control("check").returncode == 0:
+            self._last_used = time.time()
+            return
+        # -f backgrounds the master once authenticated. It inherits our stdout/stderr,
+        # so those must not be pipes, or reading them would block for its lifetime.
+        with tempfile.TemporaryFile() as err:
+            try:
+                result = subprocess.run(
+                    self.ssh[:-1] + ["-M", "-N", "-f", "-o", f"ControlPersist={self.control_persist}", self.ssh[-1]],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err,
+                    timeout=self.CONNECT_TIMEOUT,
+                )
+            except subprocess.TimeoutExpired:
+                raise ConnectionError(f"Timed out connecting to {self.user}@{self.host}")
+            if result.returncode != 0:
+                err.seek(0)
+                raise ConnectionError(err.read().decode(errors="replace").strip())
+        if self._control("check").returncode != 0:
+            raise ConnectionError(f"Master connection to {self.user}@{self.host} did not come up")
+        self._last_used = time.time()
+
+    def connect(self):
+        """Opens the master connection; fails if key-based login is not set up."""
         try:
-            with self.sftp.file(filename, 'w') as f:
-                f.write(script_content)
-        except Exception as e:
-            raise Exception(f"Failed to upload script via SFTP: {e}")
-        
-        # 2. Submit via sbatch
-        # sbatch output format: "Submitted batch job 123456"
-        code, out, err = self._run_command(f"sbatch {filename}")
-        
+            self._ensure_master()
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"❌ Connection failed: {e}")
+            return False
+        return True
+
+    def _exec(self, command, input: str = None):
+        self._ensure_master()
+        # Always give ssh a stdin of its own (empty if there is no input); otherwise it
+        # inherits ours and forwards whatever the user types, or a piped request list
+        result = subprocess.run(
+            self.ssh + [command],
+            input=(input or "").encode(),
+            capture_output=True,
+        )
+        self._last_used = time.time()
+        return result.returncode, result.stdout, result.stderr
+
+    def _stream_command(self, command):
+        self._ensure_master()
+        with subprocess.Popen(self.ssh + [command], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True) as proc:
+            for line in proc.stdout:
+                yield line
+            code = proc.wait()
+        self._last_used = time.time()
+        return code
+
+    def upload(self, content: str, path: str):
+        code, out, err = self._exec(f"cat > {shlex.quote(path)}", input=content)
         if code != 0:
-            raise Exception(f"sbatch failed: {err}")
-            
-        # Parse Job ID
-        # Expected output: "Submitted batch job 123456"
+            raise IOError(err.decode().strip())
+
+    def _mkdir(self, path: str):
+        code, out, err = self._exec(f"mkdir -p {shlex.quote(path)}")
+        if code != 0:
+            raise IOError(err.decode().strip())
+
+    def _read_file(self, path: str) -> bytes:
+        code, out, err = self._exec(f"cat {shlex.quote(path)}")
+        if code != 0:
+            raise IOError(err.decode().strip())
+        return out
+
+    def close(self):
+        """Shuts down the master connection."""
         try:
-            job_id = out.split()[-1]
-        except IndexError:
-             raise Exception(f"Could not parse job ID from sbatch output: {out}")
+            self._control("exit")
+        except subprocess.TimeoutExpired:
+            pass
+        self._last_used = 0
 
-        # Parse output filename from script
-        # Look for #SBATCH --output=...
-        output_pattern = "slurm-%j.out" # Default
-        for line in script_content.splitlines():
-            if line.strip().startswith("#SBATCH --output="):
-                output_pattern = line.strip().split("=")[1]
-                break
-        
-        self.job_files[job_id] = output_pattern
-        print(f"🚀 Job submitted! ID: {job_id} (Output: {output_pattern})")
-        return job_id
+def create_slurm_client(host, user, get_password: Callable[[], str]) -> Optional[SSHSlurmClient]:
+    """
+    Returns a connected client, preferring OpenSSH with multiplexing when the `ssh`
+    binary is available and key-based login works, and Paramiko (password) otherwise.
+    """
+    if shutil.which("ssh"):
+        client = OpenSSHSlurmClient(host, user)
+        if client.connect():
+            return client
+        print("⚠️ OpenSSH login failed, falling back to Paramiko.")
+    
+    client = ParamikoSlurmClient(host, user, get_password())
+    if client.connect():
+        return client
+    return None
 
-    def get_job_status(self, job_id: str) -> str:
-        # squeue -j <id> -h -o %T (Returns state like PENDING, RUNNING, COMPLETED)
-        # Note: If job is finished, squeue might return nothing.
-        code, out, err = self._run_command(f"squeue -j {job_id} -h -o %T")
-        
-        if not out:
-            # Check sacct for completed jobs to be sure
-            # sacct -j <id> -n -o State
-            code_sacct, out_sacct, err_sacct = self._run_command(f"sacct -j {job_id} -n -o State")
-            if out_sacct:
-                return out_sacct.split()[0].strip() # Take the first word (e.g. COMPLETED)
-            
-            # Fallback: assume completed if not in queue
-            return "COMPLETED" 
-            
-        return out.strip()
+class PilotSession:
+    """
+    Keeps one long-lived allocation open and runs scripts inside it as job steps
+    (`srun --jobid`), so only the first request waits in the queue.
+    """
+    
+    # Directives that a job step can honour (or safely ignore) inside the pilot allocation
+    COMPATIBLE_OPTIONS = {"job-name", "output", "error", "time", "J", "o", "e", "t"}
+    RENEW_MARGIN = 600 # Seconds before expiry at which the pilot is replaced
+    
+    def __init__(self, slurm: SSHSlurmClient, walltime: str = "04:00:00", nodes: int = 1):
+        self.slurm = slurm
+        self.walltime = walltime
+        self.nodes = nodes
+        self.job_id = None
+        self.expires_at = 0
 
-    def get_job_output(self, job_id: str) -> str:
-        # Determine output filename
-        pattern = self.job_files.get(job_id, "slurm-%j.out")
-        outfile = pattern.replace("%j", job_id)
+    def _remaining(self) -> float:
+        """Seconds a step started now could run: what is left of the pilot, or a fresh walltime if it will be renewed."""
+        if self.job_id is not None and time.time() <= self.expires_at - self.RENEW_MARGIN:
+            return self.expires_at - time.time()
+        return _time_seconds(self.walltime)
+
+    def fits(self, script_content: str) -> bool:
+        """
+        True if the script only uses directives that can run inside the pilot allocation
+        and its --time (if any) ends before the allocation does.
+        """
+        if not all(match.group(2) in self.COMPATIBLE_OPTIONS for match in _DIRECTIVE_RE.finditer(script_content)):
+            return False
+        match = _TIME_RE.search(script_content)
+        if not match:
+            return True
+        try:
+            return _time_seconds(match.group(1)) <= self._remaining()
+        except ValueError:
+            return False
+
+    def _is_alive(self) -> bool:
+        if self.job_id is None or time.time() > self.expires_at - self.RENEW_MARGIN:
+            return False
+        return self.slurm.get_job_status(self.job_id) == "RUNNING"
+
+    def _start(self):
+        """Submits the pilot allocation and blocks until it is running."""
+        self.close()
+        try:
+            self.job_id = self.slurm.submit_job("\n".join([
+                "#!/bin/bash",
+                f"#SBATCH -N {self.nodes}",
+                f"#SBATCH -t {self.walltime}",
+                "#SBATCH --job-name=slurm_agent_pilot",
+                "#SBATCH --output=/dev/null",
+                "sleep infinity",
+            ]) + "\n")
+        except Exception as e:
+            raise Exception(f"Pilot submission failed: {e}")
+        print(f"🛫 Pilot allocation submitted! ID: {self.job_id}")
         
-        # Retry loop to wait for file to appear (filesystem latency)
-        max_retries = 10
-        for i in range(max_retries):
+        delay = POLL_INTERVAL
+        while True:
+            status = self.slurm.get_job_status(self.job_id)
+            if status == "RUNNING":
+                break
+            if status in TERMINAL_STATES:
+                raise Exception(f"Pilot allocation {self.job_id} ended with status: {status}")
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, MAX_POLL_INTERVAL)
+        self.expires_at = time.time() + _time_seconds(self.walltime)
+        print(f"✅ Pilot allocation {self.job_id} is running.")
+
+    def run(self, script_content: str) -> Tuple[int, str, str]:
+        """Runs the script as a step of the pilot allocation, starting or renewing it as needed."""
+        if not self._is_alive():
+            self._start()
+        return self.slurm.run_in_allocation(self.job_id, script_content)
+
+    def close(self):
+        """Releases the pilot allocation."""
+        if self.job_id is not None:
             try:
-                # Try to read via SFTP first (cleaner)
-                with self.sftp.file(outfile, 'r') as f:
-                    return f.read().decode()
-            except IOError:
-                # File might not exist yet or SFTP failed
-                # Try cat as fallback
-                code, out, err = self._run_command(f"cat {outfile}")
-                if code == 0:
-                    return out
-            
-            # If we are here, both failed. Wait and retry.
-            if i < max_retries - 1:
-                time.sleep(3)
-                
-        return f"Output file {outfile} not found after retries."
+                self.slurm.cancel_job(self.job_id)
+            except Exception as e:
+                print(f"⚠️ Could not release pilot allocation {self.job_id}: {e}")
+            else:
+                print(f"🛬 Released pilot allocation {self.job_id}.")
+            self.job_id = None
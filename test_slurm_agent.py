@@ -3,10 +3,16 @@ from unittest.mock import patch
 import sys
 import io
 import os
+import tempfile
 
 # Import the classes to test
-from slurm_interface import ParamikoSlurmClient
+from slurm_interface import (
+    ParamikoSlurmClient, SSHSlurmClient, PilotSession, _SENTINEL,
+    _parse_job_id, _parse_queue, _time_seconds
+)
 from agent import AtomGPTAgent
+from prompt_cache import PromptCache
+import script_templates
 
 class TestAtomGPTAgent(unittest.TestCase):
     def setUp(self):
@@ -29,11 +35,19 @@ class TestAtomGPTAgent(unittest.TestCase):
             agent = AtomGPTAgent()
         except SystemExit:
             self.fail("Failed to connect to SLURM (SystemExit)")
+        
+        # Fresh cache, so the script has to come from AtomGPT
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        agent.cache = PromptCache(os.path.join(tmpdir.name, "cache.sqlite"))
+        self.addCleanup(agent.cache.db.close)
             
         # Run a simple job
         # We use a unique string to verify the output matches THIS job
         unique_str = f"Integration_Test_{os.urandom(4).hex()}"
-        request = f"Write a job that prints '{unique_str}'"
+        request = f"Write a SLURM job script that prints the text {unique_str} to stdout"
+        # Phrased so that no template matches and the request goes through the LLM
+        self.assertIsNone(script_templates.classify(request))
         
         output = agent.run_job(request)
         
@@ -42,6 +56,131 @@ class TestAtomGPTAgent(unittest.TestCase):
         self.assertIsNotNone(output)
         self.assertIn(unique_str, output)
 
+class TestPromptCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = PromptCache(os.path.join(self.tmpdir.name, "cache.sqlite"))
+
+    def tearDown(self):
+        self.cache.db.close()
+        self.tmpdir.cleanup()
+
+    def test_structurally_similar_request_hits(self):
+        script = "#!/bin/bash\n#SBATCH --ntasks=64\npython3 -c \"print('hello')\""
+        self.cache.put("m", "sys", "Run on 64 cores and print 'hello'", script)
+
+        cached = self.cache.get("m", "sys", "run on 96 cores and print 'bye'")
+
+        self.assertIn("--ntasks=96", cached)
+        self.assertIn("print('bye')", cached)
+
+    def test_quoted_value_only_replaced_as_whole_token(self):
+        script = "#!/bin/bash\n#SBATCH --job-name=echo\necho 'a'"
+        self.cache.put("m", "sys", "Write a job that prints 'a'", script)
+
+        cached = self.cache.get("m", "sys", "Write a job that prints 'Z'")
+
+        self.assertEqual(cached, "#!/bin/bash\n#SBATCH --job-name=echo\necho 'Z'")
+
+    def test_empty_quoted_value_misses(self):
+        self.cache.put("m", "sys", "Write a job that prints ''", "#!/bin/bash\necho ''")
+        self.assertIsNone(self.cache.get("m", "sys", "Write a job that prints 'x'"))
+
+    def test_ambiguous_number_misses(self):
+        script = "#!/bin/bash\n#SBATCH --nodes=1\n#SBATCH --ntasks=1\necho 1"
+        self.cache.put("m", "sys", "Print the number 1", script)
+        self.assertIsNone(self.cache.get("m", "sys", "Print the number 16"))
+
+    def test_different_system_prompt_misses(self):
+        self.cache.put("m", "sys", "Run on 64 cores", "#!/bin/bash")
+        self.assertIsNone(self.cache.get("m", "other", "Run on 64 cores"))
+
+class _StubSlurmClient(SSHSlurmClient):
+    """Offline client whose _exec returns canned (exit code, stdout, stderr)."""
+    def __init__(self, jobs_file, result=(0, b"", b"")):
+        super().__init__("host", "user", jobs_file)
+        self.result = result
+
+    def connect(self): return True
+    def close(self): pass
+    def _exec(self, command, input=None): return self.result
+    def _stream_command(self, command): return iter(())
+    def upload(self, content, path): pass
+    def _mkdir(self, path): pass
+    def _read_file(self, path): raise IOError(path)
+
+class TestSlurmParsing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.client = _StubSlurmClient(os.path.join(self.tmpdir.name, "jobs.json"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parse_job_id(self):
+        self.assertEqual(_parse_job_id("123;cluster\n"), "123")
+        with self.assertRaises(Exception):
+            _parse_job_id("sbatch: error: invalid partition")
+
+    def test_parse_queue_expands_array_ranges(self):
+        states = _parse_queue(b"77_[0-2,5%2] PENDING\n77_3 RUNNING\n\n80 RUNNING\n")
+        self.assertEqual(states, {
+            "77_0": "PENDING", "77_1": "PENDING", "77_2": "PENDING", "77_5": "PENDING",
+            "77_3": "RUNNING", "80": "RUNNING",
+        })
+
+    def test_time_seconds_formats(self):
+        self.assertEqual(_time_seconds("5"), 300)
+        self.assertEqual(_time_seconds("5:30"), 330)
+        self.assertEqual(_time_seconds("01:00:00"), 3600)
+        self.assertEqual(_time_seconds("2-1"), 2 * 86400 + 3600)
+        self.assertEqual(_time_seconds("1-00:00:01"), 86401)
+        self.assertEqual(_time_seconds("UNLIMITED"), float("inf"))
+        with self.assertRaises(ValueError):
+            _time_seconds("soon")
+
+    def test_exec_batched_splits_per_command(self):
+        sep = _SENTINEL.encode()
+        out = b"a\n\n" + sep + b"0\n\n" + sep + b"1\n"
+        err = b"\n" + sep + b"\nboom\n\n" + sep + b"\n"
+        self.client.result = (0, out, err)
+        self.assertEqual(
+            self.client._exec_batched(["echo a", "false"]),
+            [(0, b"a", b""), (1, b"", b"boom")]
+        )
+
+    def test_exec_batched_truncated_output_raises(self):
+        self.client.result = (255, b"", b"Connection closed")
+        with self.assertRaisesRegex(Exception, "Connection closed"):
+            self.client._exec_batched(["echo a", "echo b"])
+
+    def test_pilot_fits_checks_directives_and_time(self):
+        pilot = PilotSession(self.client, walltime="01:00:00")
+        self.assertTrue(pilot.fits("#!/bin/bash\n#SBATCH --time=00:05:00\necho hi"))
+        self.assertTrue(pilot.fits("#!/bin/bash\necho hi"))
+        self.assertFalse(pilot.fits("#!/bin/bash\n#SBATCH -t 2:00:00\necho hi"))
+        self.assertFalse(pilot.fits("#!/bin/bash\n#SBATCH --mem=4G\necho hi"))
+
+class TestScriptTemplates(unittest.TestCase):
+    def test_classify_extracts_parameters(self):
+        intent, params = script_templates.classify('Run python code "print(1+1)" on 64 cores for 90 minutes')
+        self.assertEqual(intent, "python_oneliner")
+        self.assertEqual(params, {"code": "print(1+1)", "cores": "64", "time": "01:30:00"})
+
+    def test_unrecognized_request(self):
+        self.assertIsNone(script_templates.classify("Train a model on the MNIST dataset"))
+
+    @unittest.skipIf(script_templates.Environment is None, "jinja2 not installed")
+    def test_render_quotes_code(self):
+        script = script_templates.render("Write a job that prints 'it's done'")
+        self.assertIn("#SBATCH --time=00:05:00", script)
+        self.assertIn("""echo 'it'"'"'s done'""", script.splitlines())
+
+    @unittest.skipIf(script_templates.Environment is None, "jinja2 not installed")
+    def test_render_echo_honours_cores(self):
+        script = script_templates.render("Write a job that prints 'hi' on 8 cores")
+        self.assertIn("#SBATCH --cpus-per-task=8", script.splitlines())
+
 
 
 